@@ -5,6 +5,21 @@ import hoomd
 import sys
 import os
 import collections
+import hashlib
+import json
+try:
+    import Instrument
+except ImportError:
+    # Timing is opt-in through DPD_TIMINGS, run without the hook
+    import contextlib
+    class Instrument(object):
+        @staticmethod
+        @contextlib.contextmanager
+        def stage(name, **fields):
+            yield dict(fields)
+        @staticmethod
+        def timed(name):
+            return lambda function: function
 
 ################################################################
 # Creating Initial Stucture
@@ -380,114 +395,253 @@ Dihedrals = {
         "CH,CH2,C,C3b"      :   {"id":21, "func": 3, "C0": 12.4977, "C1":-14.5512, "C2":-1.15671, "C3": 14.9861, "C4": 0.0000, "C5": 0.0000},
         }
 
-snapshot = hoomd.data.make_snapshot(N=12727, 
-        box=hoomd.data.boxdim(Lx=75,Ly=75,Lz=75),
-        particle_types=["CTL1", "CTL2", "CTL3",
-            "SL", "O2L", "HAL1", "HAL2", "HAL3",
-            "CL", "OBL", "OSL", "CT0", "SOD", "HT",
-            "OT", "C3a", "C3b", "C3c", "CH2", "CH",
-            "C", "ZRS", "CLS"],
-        bond_types=["CTL3,CL",  "CTL2,CL",  "CTL1,CL",  "OBL,CL",   "OSL,CL",
-            "CTL1,HAL1", "CTL2,HAL2", "CTL3,HAL3", "CTL3,OSL", "CTL2,OSL",
-            "CTL1,OSL", "CTL1,CTL1", "CTL1,CTL2", "CH,CTL2",  "CTL1,CTL3",
-            "CTL2,CTL2", "CTL2,CTL3", "CTL3,CTL3", "SL,O2L",   "SL,OSL",
-            "SL,CTL1",  "CT0,CTL3", "CT0,CTL2", "HT,HT", "HT,OT",    "CH,CH2",
-            "CH2,C",    "C3b,C",    "C3b,CH",   "CH,C3c", "CH2,CH2",
-            "CH2,C3a"],
-        angle_types=["OBL,CL,CTL3",      "OBL,CL,CTL2",      "OBL,CL,CTL1",
-            "OSL,CL,OBL", "CL,OSL,CTL1",      "CL,OSL,CTL2", "CL,OSL,CTL3",
-            "HAL2,CTL2,CL", "HAL3,CTL3,CL", "CTL2,CTL2,CL",     "CTL3,CTL2,CL",
-            "CTL2,CTL1,CL", "CTL1,CTL2,CL",     "OSL,CL,CTL3", "OSL,CL,CTL2",
-            "OSL,CTL1,CTL2", "OSL,CTL1,CTL3", "OSL,CTL2,CTL1", "OSL,CTL2,CH",
-            "OSL,CTL2,CTL2", "OSL,CTL2,CTL3", "HAL2,CTL2,HAL2",
-            "HAL3,CTL3,HAL3", "HAL1,CTL1,OSL", "HAL2,CTL2,OSL",
-            "HAL3,CTL3,OSL", "HAL1,CTL1,CTL1", "HAL1,CTL1,CTL2",
-            "HAL1,CTL1,CTL3", "HAL2,CTL2,CTL1", "HAL2,CTL2,CH",
-            "HAL2,CTL2,CTL2", "HAL2,CTL2,CTL3", "HAL3,CTL3,CTL1",
-            "HAL3,CTL3,CTL2", "HAL3,CTL3,CTL3", "CTL1,CTL1,CTL1",
-            "CTL1,CTL1,CTL2", "CTL1,CTL1,CTL3", "CTL1,CTL2,CTL1",
-            "CTL1,CTL2,CTL2", "CTL1,CTL2,CTL3", "CTL2,CTL1,CTL2",
-            "CTL2,CTL1,CTL3", "CTL2,CTL2,CTL2", "CTL2,CTL2,CTL3", "O2L,SL,O2L",
-            "O2L,SL,OSL", "CTL2,OSL,SL",      "CTL3,OSL,SL", "SL,CTL1,HAL1",
-            "SL,CTL1,CL", "SL,CTL1,CTL2",     "CTL1,CL,OSL", "O2L,SL,CTL1",
-            "HAL1,CTL1,CL", "CTL3,CT0,CTL3", "HAL2,CTL2,CT0", "CTL3,CT0,CTL2",
-            "HAL3,CTL3,CT0", "CT0,CTL2,CTL1", "CTL3,CTL1,CTL3",   "HT,OT,HT",
-            "C3b,C,C3b", "C3b,C,CH2", "C3b,CH,CH2",       "C3b,CH,C3b",
-            "C,CH2,CH", "C3c,CH,CH2", "CH2,CH,CH2",       "CTL2,CH,CH2",
-            "C3a,CH2,CH", "CH,CH2,CH2", "CH2,CH2,CH2", "CH2,CH2,C3a"],
-        dihedral_types=["SL,CTL1,CL,OBL", "SL,CTL1,CL,OSL", "SL,CTL1,CTL2,CL",
-            "CTL1,CL,OSL,CTL2", "CTL1,CTL2,CL,OBL", "CTL1,CTL2,CL,OSL",
-            "CTL2,CTL1,CL,OBL", "CTL2,CTL1,CL,OSL", "CTL2,CL,OSL,CTL2",
-            "CL,OSL,CTL2,CH", "CL,CTL1,CTL2,CL", "OBL,CL,OSL,CTL2",
-            "OSL,CTL2,CH,CH2", "CTL2,CH,CH2,CH2", "CTL2,CH,CH2,C3a",
-            "CH,CH2,CH2,CH2", "CH2,CH2,CH2,C3a", "CH2,CH,CH2,C3a",
-            "CH2,CH,CH2,CH2", "C,CH2,CH,C3b", "CH,CH2,C,C3b"])
+################################################################
+# Topology Compiler
+################################################################
 
-dirwithstuff = os.path.abspath(sys.argv[1])
-justText = os.path.join(dirwithstuff,'justname.txt')
-justCoords = os.path.join(dirwithstuff,'justcoords.txt') 
-with open(justText,'r') as nameFile:
-    snapshotNames = [line.strip() for line in nameFile.readlines()]
-snapshot.particles.position[:] = np.genfromtxt(justCoords,delimiter=',')
-snapshot.particles.typeid[:] = [Particles[atomToParticle[atom]["type"]]["id"] for atom in snapshotNames]
-snapshot.particles.mass[:] = [Particles[atomToParticle[atom]["type"]]["mass"] for atom in snapshotNames]
-snapshot.particles.charge[:] = [Particles[atomToParticle[atom]["type"]]["charge"] for atom in snapshotNames]
+def sortedTypes(Types):
+    """	Arguments:
+            Types : dict; Particles, Bonds, Angles or Dihedrals
+        Returns:
+            list; names of the types ordered by their id
+    """
+    return sorted(Types, key=lambda name: Types[name]["id"])
+
+def compileTemplates(atomNames, kind, size):
+    """	Arguments:
+            atomNames : list; names in atomToParticle
+            kind : str; "bonds", "angles" or "dihedrals"
+            size : int; number of atoms in a group of that kind
+        Returns:
+            starts : np array; first template row of every name
+            counts : np array; number of templates of every name
+            offsets : np array; (templates, size) atom offsets
+    """
+    Templates = [atomToParticle[name][kind] for name in atomNames]
+    counts = np.array([len(groups) for groups in Templates], dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    offsets = np.array([group for groups in Templates for group in groups],
+                       dtype=np.int64).reshape(-1, size)
+    return starts, counts, offsets
 
-totalBonds,totalAngles,totalDihedrals = [],[],[]
-totalBondIds,totalAngleIds,totalDihedralIds = [],[],[]
-atomIndex = 0
-for atom in snapshotNames:
-    for bond in atomToParticle[atom]["bonds"]:
-        totalBonds.append(bond+atomIndex)
-    for angle in atomToParticle[atom]["angles"]:
-        totalAngles.append(angle+atomIndex)
-    for dih in atomToParticle[atom]["dihedrals"]:
-        totalDihedrals.append(dih+atomIndex)
-    atomIndex += 1
-totalBonds = np.array(totalBonds)
-totalAngles = np.array(totalAngles)
-totalDihedrals = np.array(totalDihedrals)
+def compileTypeTable(Types, size):
+    """	Arguments:
+            Types : dict; Bonds, Angles or Dihedrals
+            size : int; number of atoms in a group of that kind
+        Returns:
+            table : np array; type id of every encoded sequence
+                    of particle ids, -1 where there is none
+        Every type is entered in both directions, the one it is
+        written in winning, so a group is found whichever end
+        it is listed from
+    """
+    numParticles = len(Particles)
+    weights = numParticles**np.arange(size-1, -1, -1)
+    Keys = np.array([[Particles[particle]["id"] for particle in name.split(',')]
+                        for name in Types], dtype=np.int64)
+    ids = np.array([Types[name]["id"] for name in Types]) - 1 # Dictionary indexing started at 1
+    table = np.full(numParticles**size, -1, dtype=np.int64)
+    table[Keys[:,::-1].dot(weights)] = ids
+    table[Keys.dot(weights)] = ids
+    return table
 
-for bond in totalBonds:
-    try:
-        totalBondIds.append(Bonds[','.join([atomToParticle[snapshotNames[bond[0]]]["type"],atomToParticle[snapshotNames[bond[1]]]["type"]])]["id"])
-    except KeyError:
-        totalBondIds.append(Bonds[','.join([atomToParticle[snapshotNames[bond[1]]]["type"],atomToParticle[snapshotNames[bond[0]]]["type"]])]["id"])
-totalBondIds = np.array(totalBondIds)
+def compileGroups(nameIds, starts, counts, offsets):
+    """	Arguments:
+            nameIds : np array; index in atomToParticle of every atom
+            starts, counts, offsets : from compileTemplates
+        Returns:
+            np array; (groups, size) atom indices, in the same
+                      order as walking the atoms one by one
+    """
+    atomCounts = counts[nameIds]
+    atoms = np.repeat(np.arange(nameIds.shape[0]), atomCounts)
+    rows = (np.repeat(starts[nameIds] - (np.cumsum(atomCounts) - atomCounts), atomCounts)
+            + np.arange(atoms.shape[0]))
+    groups = offsets[rows] + atoms[:,None]
+    outside = (groups < 0) | (groups >= nameIds.shape[0])
+    if outside.any():
+        raise SystemExit('Group of atom {} points outside the system'.format(
+                    atoms[np.argmax(outside.any(axis=1))]))
+    return groups
 
-for angle in totalAngles:
-    try:
-        totalAngleIds.append(Angles[','.join([atomToParticle[snapshotNames[angle[0]]]["type"],atomToParticle[snapshotNames[angle[1]]]["type"],atomToParticle[snapshotNames[angle[2]]]["type"]])]["id"])
-    except KeyError:
-        totalAngleIds.append(Angles[','.join([atomToParticle[snapshotNames[angle[2]]]["type"],atomToParticle[snapshotNames[angle[1]]]["type"],atomToParticle[snapshotNames[angle[0]]]["type"]])]["id"])
-totalAngleIds = np.array(totalAngleIds)
+def compileTypeIds(groups, typeIds, table, kind):
+    """	Arguments:
+            groups : np array; (groups, size) atom indices
+            typeIds : np array; particle id of every atom
+            table : np array; from compileTypeTable
+            kind : str; name of the groups for error messages
+        Returns:
+            ids : np array; type id of every group
+    """
+    weights = len(Particles)**np.arange(groups.shape[1]-1, -1, -1)
+    ids = table[typeIds[groups].dot(weights)]
+    if (ids < 0).any():
+        particleNames = np.array(sortedTypes(Particles))
+        missing = particleNames[typeIds[groups[np.argmax(ids < 0)]]]
+        raise SystemExit('No {} type for: {}'.format(kind, ','.join(missing)))
+    return ids
 
-#To get names of dihedral types
-#dihnames = OrderedSet([])
-#for dih in totalDihedrals:
-#    dihname = ','.join([atomToParticle[snapshotNames[dih[0]]]["type"],atomToParticle[snapshotNames[dih[1]]]["type"],atomToParticle[snapshotNames[dih[2]]]["type"],atomToParticle[snapshotNames[dih[3]]]["type"]])
-#    dihnames.add(dihname)
-#print('\n'.join(['"%s",'%(name) for name in dihnames]))
-for dih in totalDihedrals:
-    totalDihedralIds.append(Dihedrals[','.join([atomToParticle[snapshotNames[dih[0]]]["type"],atomToParticle[snapshotNames[dih[1]]]["type"],atomToParticle[snapshotNames[dih[2]]]["type"],atomToParticle[snapshotNames[dih[3]]]["type"]])]["id"])
-totalDihedralIds = np.array(totalDihedralIds)
+def compileTopology(snapshotNames):
+    """	Arguments:
+            snapshotNames : list; atom name of every atom
+        Returns:
+            Topology : dict; np arrays of particle type ids, masses,
+                       charges, and the groups and type ids of the
+                       bonds, angles and dihedrals
+        Turns the force field dictionaries into integer lookup
+        tables once, then resolves every atom with indexing
+    """
+    atomNames = list(atomToParticle)
+    uniqueNames, inverse = np.unique(np.asarray(snapshotNames), return_inverse=True)
+    unknown = set(uniqueNames) - set(atomNames)
+    if unknown:
+        raise SystemExit('Unknown atom names: {}'.format(','.join(sorted(unknown))))
+    nameIds = np.array([atomNames.index(name) for name in uniqueNames],
+                       dtype=np.int64)[inverse.ravel()]
+    nameToParticle = np.array([Particles[atomToParticle[name]["type"]]["id"]
+                                for name in atomNames], dtype=np.int64)
+    particleNames = sortedTypes(Particles)
+    typeIds = nameToParticle[nameIds]
+    Topology = {
+        "typeid": typeIds,
+        "mass": np.array([Particles[name]["mass"] for name in particleNames])[typeIds],
+        "charge": np.array([Particles[name]["charge"] for name in particleNames])[typeIds]
+        }
+    for kind, idName, Types, size in [("bonds", "bondIds", Bonds, 2),
+                                      ("angles", "angleIds", Angles, 3),
+                                      ("dihedrals", "dihedralIds", Dihedrals, 4)]:
+        groups = compileGroups(nameIds, *compileTemplates(atomNames, kind, size))
+        Topology[kind] = groups
+        Topology[idName] = compileTypeIds(groups,
+                                              typeIds,
+                                              compileTypeTable(Types, size),
+                                              kind)
+    return Topology
+
+################################################################
+# Caching
+################################################################
+
+def hashTopology(nameFile):
+    """	Arguments:
+            nameFile : str; path to justname.txt
+        Returns:
+            str; hash of the atom names and every force field
+                 table the topology is compiled from
+    """
+    fieldTables = {
+        "atomToParticle": {name: {key: [group.tolist() for group in value]
+                                        if isinstance(value, list) else value
+                                    for key, value in atom.items()}
+                            for name, atom in atomToParticle.items()},
+        "Particles": Particles,
+        "Bonds": Bonds,
+        "Angles": Angles,
+        "Dihedrals": Dihedrals
+        }
+    key = hashlib.sha1(json.dumps(fieldTables, sort_keys=True).encode())
+    with open(nameFile, 'rb') as F:
+        for block in iter(lambda: F.read(2**24), b''):
+            key.update(block)
+    return key.hexdigest()
+
+def loadTopology(nameFile, cacheDir):
+    """	Arguments:
+            nameFile : str; path to justname.txt
+            cacheDir : str; directory holding compiled topologies
+        Returns:
+            Topology : dict; np arrays from compileTopology
+        Compiles the topology only when no topology_<hash>.npz
+        exists for the same names and force field yet
+    """
+    cacheFile = os.path.join(cacheDir, 'topology_{}.npz'.format(hashTopology(nameFile)[:16]))
+    if os.path.exists(cacheFile):
+        with np.load(cacheFile) as Cache:
+            return {key: Cache[key] for key in Cache.files}
+    with open(nameFile,'r') as F:
+        snapshotNames = [line.strip() for line in F.readlines()]
+    Topology = compileTopology(snapshotNames)
+    with open(cacheFile+'.tmp', 'wb') as F:
+        np.savez(F, **Topology)
+    os.replace(cacheFile+'.tmp', cacheFile)
+    return Topology
+
+def convertCoordinates(textFile, binaryFile):
+    """	Arguments:
+            textFile : str; comma separated x,y,z of every atom
+            binaryFile : str; .npy file to write
+        Returns:
+            None
+    """
+    with open(textFile, 'r') as F:
+        Coordinates = np.fromstring(F.read().replace(',', ' '), sep=' ').reshape(-1, 3)
+    with open(binaryFile+'.tmp', 'wb') as F:
+        np.save(F, Coordinates)
+    os.replace(binaryFile+'.tmp', binaryFile)
+
+def loadCoordinates(textFile, binaryFile):
+    """	Arguments:
+            textFile : str; path to justcoords.txt
+            binaryFile : str; path to justcoords.npy
+        Returns:
+            np array; (N, 3) memory-mapped coordinates
+        Converts the text coordinates first when there is no
+        binary copy or the text file is newer than it
+    """
+    if not os.path.exists(textFile) and not os.path.exists(binaryFile):
+        raise SystemExit("File does not exist:\n\t{}".format(textFile))
+    if (os.path.exists(textFile) and
+            (not os.path.exists(binaryFile) or
+             os.path.getmtime(textFile) > os.path.getmtime(binaryFile))):
+        convertCoordinates(textFile, binaryFile)
+    return np.load(binaryFile, mmap_mode='r')
+
+################################################################
+# Creating Snapshot
+################################################################
+
+# Usage: rm.py <directory> [<cache directory>]
+dirwithstuff = os.path.abspath(sys.argv[1])
+cacheDir = os.path.abspath(sys.argv[2]) if len(sys.argv) > 2 else dirwithstuff
+justText = os.path.join(dirwithstuff,'justname.txt')
+justCoords = os.path.join(dirwithstuff,'justcoords.txt') 
+justBinary = os.path.join(dirwithstuff,'justcoords.npy')
+with Instrument.stage('topology', directory=dirwithstuff):
+    Topology = loadTopology(justText, cacheDir)
+with Instrument.stage('coordinates', directory=dirwithstuff):
+    Coordinates = loadCoordinates(justCoords, justBinary)
+if Coordinates.shape[0] != Topology["typeid"].shape[0]:
+    raise SystemExit('{} atoms in justname.txt but {} coordinates'.format(
+                Topology["typeid"].shape[0], Coordinates.shape[0]))
+
+snapshot = hoomd.data.make_snapshot(N=Topology["typeid"].shape[0],
+        box=hoomd.data.boxdim(Lx=75,Ly=75,Lz=75),
+        particle_types=sortedTypes(Particles),
+        bond_types=sortedTypes(Bonds),
+        angle_types=sortedTypes(Angles),
+        dihedral_types=sortedTypes(Dihedrals))
+snapshot.particles.position[:] = Coordinates
+snapshot.particles.typeid[:] = Topology["typeid"]
+snapshot.particles.mass[:] = Topology["mass"]
+snapshot.particles.charge[:] = Topology["charge"]
 
-snapshot.bonds.resize(totalBonds.shape[0])
-snapshot.bonds.group[:] = totalBonds
-snapshot.bonds.typeid[:] = totalBondIds - 1 # Dictionary indexing started at 1
+snapshot.bonds.resize(Topology["bonds"].shape[0])
+snapshot.bonds.group[:] = Topology["bonds"]
+snapshot.bonds.typeid[:] = Topology["bondIds"]
 
-snapshot.angles.resize(totalAngles.shape[0])
-snapshot.angles.group[:] = totalAngles
-snapshot.angles.typeid[:] = totalAngleIds - 1 # Dictionary indexing started at 1
+snapshot.angles.resize(Topology["angles"].shape[0])
+snapshot.angles.group[:] = Topology["angles"]
+snapshot.angles.typeid[:] = Topology["angleIds"]
 
-snapshot.dihedrals.resize(totalDihedrals.shape[0])
-snapshot.dihedrals.group[:] = totalDihedrals
-snapshot.dihedrals.typeid[:] = totalDihedralIds - 1 # Dictionary indexing started at 1
+snapshot.dihedrals.resize(Topology["dihedrals"].shape[0])
+snapshot.dihedrals.group[:] = Topology["dihedrals"]
+snapshot.dihedrals.typeid[:] = Topology["dihedralIds"]
 
 ################################################################
 # Creating Initial Stucture
 ################################################################
 
-hoomd.init.read_snapshot(snapshot)
-hoomd.dump.gsd("initialization.gsd")
+with Instrument.stage('initialization', atoms=Topology["typeid"].shape[0]):
+    hoomd.init.read_snapshot(snapshot)
+    hoomd.dump.gsd("initialization.gsd")
 